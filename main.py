@@ -1,20 +1,58 @@
 #!/usr/bin/env python3
 
 from base64 import b64decode
-from multiprocessing.pool import ThreadPool
+from contextlib import closing
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from requests.adapters import HTTPAdapter
 from tqdm import tqdm
+from urllib.parse import quote
+from urllib3.util.retry import Retry
 import gpsoauth
 import hashlib
 import json
+import multiprocessing
 import os
+import queue
 import requests
+import sqlite3
+import sys
+import threading
+import time
+
+try:
+    from blake3 import blake3
+except ImportError:
+    blake3 = None
+
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    json_loads = json.loads
 
 
 CONFIG_FILE = "settings.json"
+HASH_BUFFER_SIZE = 1 << 20
+DOWNLOAD_CHUNK_SIZE = 1 << 20
+DOWNLOAD_PREFETCH_CHUNKS = 2
+DOWNLOAD_ATTEMPTS = 2
+HTTP_POOL_CONNECTIONS = 16
+HTTP_POOL_MAXSIZE = 32
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+VERIFIED_CACHE_FILE = "verified.sqlite"
+CKSUMS_BUFFER_SIZE = 64 * 1024
+CKSUMS_BATCH_LINES = 128
+PROGRESS_INTERVAL = 0.05
+FADVISE = hasattr(os, "posix_fadvise")
+FALLOCATE = hasattr(os, "posix_fallocate")
+DEFAULT_POOL_SIZE = 16
 CONFIG_TEMPLATE = {
     "gmail": "alias@gmail.com",
     "password": "",
     "android_id": "0000000000000000",
+    "pool_size": DEFAULT_POOL_SIZE,
+}
+CONFIG_DEFAULTS = {
+    "pool_size": DEFAULT_POOL_SIZE,
 }
 
 
@@ -30,16 +68,25 @@ def get_configs():
     """
     try:
         with open(CONFIG_FILE, "r", encoding="utf-8") as f:
-            config = json.load(f)
+            config = {**CONFIG_DEFAULTS, **json.load(f)}
         for key in CONFIG_TEMPLATE:
             if key not in config:
                 raise KeyError(f"Missing key '{key}' in config file.")
-        return config
     except (FileNotFoundError, json.JSONDecodeError, KeyError) as e:
         print(f"Error loading configuration: {e}")
         create_settings_file()
         return CONFIG_TEMPLATE
 
+    try:
+        pool_size = int(config["pool_size"])
+    except (TypeError, ValueError):
+        pool_size = 0
+    if pool_size < 1:
+        print(f"Invalid 'pool_size' {config['pool_size']!r} in config file, using {DEFAULT_POOL_SIZE}.")
+        pool_size = DEFAULT_POOL_SIZE
+    config["pool_size"] = pool_size
+    return config
+
 
 def create_settings_file():
     """
@@ -50,6 +97,22 @@ def create_settings_file():
     print(f"A new template file '{CONFIG_FILE}' has been created. Please fill in your details.")
 
 
+def local_path(name):
+    """
+    Convert the API name of a backup file to its local path.
+
+    Args:
+        name (str): The file name, e.g. "clients/wa/backups/<id>/files/<path>".
+
+    Returns:
+        str: The path without the leading "clients/wa/backups/" components.
+    """
+    path = name.split("/", 3)[3]
+    if os.path.sep == "/":
+        return path
+    return path.replace("/", os.path.sep)
+
+
 def human_size(size):
     """
     Convert a size in bytes to a human-readable format.
@@ -60,55 +123,239 @@ def human_size(size):
     Returns:
         str: A string representation of the size in a human-readable format (e.g., "10 MiB").
     """
-    for s in ["B", "kiB", "MiB", "GiB", "TiB", "PiB", "EiB", "ZiB", "YiB"]:
-        if abs(size) < 1024:
-            break
-        size = int(size / 1024)
-    return f"{size}{s}"
+    units = ("B", "kiB", "MiB", "GiB", "TiB", "PiB", "EiB", "ZiB", "YiB")
+    i = 0
+    while abs(size) >= 1024 and i < len(units) - 1:
+        size >>= 10
+        i += 1
+    return f"{size}{units[i]}"
+
+
+def hash_file(file, *digests):
+    """
+    Feed the contents of a file through one or more hash objects in a single pass.
+
+    The file is read once and never again, so the kernel is told to read it
+    ahead and not keep it in the page cache afterwards.
+
+    Args:
+        file (str): The path to the file.
+        *digests: The hash objects to update.
+
+    Returns:
+        tuple: The updated hash objects.
+    """
+    with open(file, "br", buffering=0) as input:
+        if FADVISE:
+            os.posix_fadvise(input.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        try:
+            if len(digests) == 1 and sys.version_info >= (3, 11):
+                return (hashlib.file_digest(input, lambda: digests[0]),)
+            buffer = memoryview(bytearray(HASH_BUFFER_SIZE))
+            while True:
+                n = input.readinto(buffer)
+                if not n:
+                    break
+                for digest in digests:
+                    digest.update(buffer[:n])
+        finally:
+            if FADVISE:
+                os.posix_fadvise(input.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+    return digests
+
+
+def verify_file(file, md5, blake3_hex=None):
+    """
+    Verify a file against its MD5 hash.
+
+    If the BLAKE3 hash of a previous verification is given, only BLAKE3 is
+    computed, which is much faster than MD5. This is a plain function so it
+    can run in a worker process.
 
+    Args:
+        file (str): The path to the file.
+        md5 (bytes): The expected MD5 hash of the file.
+        blake3_hex (str): Optional BLAKE3 hash the file had when it last matched md5.
 
-def have_file(file, size, md5):
+    Returns:
+        tuple: Whether the file matches the hash, and its BLAKE3 hash as a hex
+        string (None if the blake3 package is not installed).
+    """
+    if blake3 is None:
+        return md5 == hash_file(file, hashlib.md5())[0].digest(), None
+    if blake3_hex is not None:
+        return blake3_hex == hash_file(file, blake3())[0].hexdigest(), blake3_hex
+
+    md5_digest, blake3_digest = hash_file(file, hashlib.md5(), blake3())
+    return md5 == md5_digest.digest(), blake3_digest.hexdigest()
+
+
+class VerifiedCache:
+    """Remember the hashes of local files that have already been verified."""
+
+    def __init__(self, path=VERIFIED_CACHE_FILE):
+        """
+        Open the cache database, creating it if needed.
+
+        Args:
+            path (str): The path to the SQLite database.
+        """
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS verified "
+            "(path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, md5 BLOB, blake3 TEXT)"
+        )
+
+    def get(self, file):
+        """
+        Look up the last verification of a file.
+
+        Args:
+            file (str): The path to the file.
+
+        Returns:
+            tuple: The size, mtime_ns, MD5 hash and BLAKE3 hex hash (or None) the
+            file had when it was verified, or None if it never was.
+        """
+        with self.lock:
+            return self.db.execute(
+                "SELECT size, mtime_ns, md5, blake3 FROM verified WHERE path = ?", (file,)
+            ).fetchone()
+
+    def put(self, file, stat, md5, blake3_hex=None):
+        """
+        Record the verified hashes of a file.
+
+        Args:
+            file (str): The path to the file.
+            stat (os.stat_result): The status of the file when it was verified.
+            md5 (bytes): The MD5 hash of the file.
+            blake3_hex (str): Optional BLAKE3 hash of the file as a hex string.
+        """
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO verified VALUES (?, ?, ?, ?, ?)",
+                (file, stat.st_size, stat.st_mtime_ns, md5, blake3_hex),
+            )
+
+    def close(self):
+        """Close the cache database."""
+        self.db.close()
+
+
+def have_file(file, size, md5, verified=None, hasher=None):
     """
     Determine whether the named file's contents have the given size and hash.
 
+    Files recorded in the cache with their current size and mtime are trusted
+    without reading them. Files whose mtime changed since are re-checked with
+    their recorded BLAKE3 hash when there is one.
+
     Args:
         file (str): The path to the file.
         size (int): The expected size of the file.
         md5 (bytes): The expected MD5 hash of the file.
+        verified (VerifiedCache): Optional cache of already verified files.
+        hasher (concurrent.futures.Executor): Optional executor to hash the file on.
 
     Returns:
         bool: True if the file exists and matches the size and hash; otherwise, False.
     """
-    if not os.path.exists(file) or size != os.path.getsize(file):
+    try:
+        stat = os.stat(file)
+    except FileNotFoundError:
+        return False
+    if size != stat.st_size:
         return False
 
-    digest = hashlib.md5()
-    with open(file, "br") as input:
-        while True:
-            b = input.read(8 * 1024)
-            if not b:
-                break
-            digest.update(b)
+    blake3_hex = None
+    if verified is not None:
+        known = verified.get(file)
+        if known is not None:
+            known_size, known_mtime_ns, known_md5, known_blake3_hex = known
+            if (known_size, known_mtime_ns) == (stat.st_size, stat.st_mtime_ns):
+                return md5 == known_md5
+            if md5 == known_md5:
+                blake3_hex = known_blake3_hex
+
+    if hasher is None:
+        matches, blake3_hex = verify_file(file, md5, blake3_hex)
+    else:
+        matches, blake3_hex = hasher.submit(verify_file, file, md5, blake3_hex).result()
+    if not matches:
+        return False
+    if verified is not None:
+        verified.put(file, stat, md5, blake3_hex)
+    return True
 
-    return md5 == digest.digest()
 
-def download_file(file, stream):
+def download_file(file, stream, size, md5):
     """
-    Download a file from the given stream.
+    Download a file from the given stream, verifying its MD5 hash on the fly.
+
+    Chunks are received on a background thread while the previous ones are
+    hashed and written to disk, so the network and the disk are kept busy at
+    the same time.
 
     Args:
         file (str): The path to save the downloaded file.
         stream (requests.Response): The response stream from which to download the file.
+        size (int): The expected size of the file, used to preallocate it.
+        md5 (bytes): The expected MD5 hash of the file.
+
+    Returns:
+        tuple: Whether the downloaded contents match the hash, and their BLAKE3
+        hash as a hex string (None if the blake3 package is not installed).
     """
     os.makedirs(os.path.dirname(file), exist_ok=True)
-    with open(file, "bw") as dest:
-        for chunk in stream.iter_content(chunk_size=None):
-            dest.write(chunk)
+    chunks = queue.Queue(maxsize=DOWNLOAD_PREFETCH_CHUNKS)
+    errors = []
+    digests = [hashlib.md5()] if blake3 is None else [hashlib.md5(), blake3()]
+
+    def receive():
+        try:
+            for chunk in stream.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                chunks.put(chunk)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            chunks.put(None)
+
+    receiver = threading.Thread(target=receive, daemon=True)
+    receiver.start()
+    received = False
+    try:
+        with open(file, "bw", buffering=DOWNLOAD_CHUNK_SIZE) as dest:
+            if FALLOCATE and size > 0:
+                try:
+                    os.posix_fallocate(dest.fileno(), 0, size)
+                except OSError:
+                    pass
+            for chunk in iter(chunks.get, None):
+                for digest in digests:
+                    digest.update(chunk)
+                dest.write(chunk)
+            received = True
+            dest.truncate()
+    except BaseException:
+        stream.close()
+        if not received:
+            for _ in iter(chunks.get, None):
+                pass
+        raise
+    finally:
+        receiver.join()
+
+    if errors:
+        raise errors[0]
+    return md5 == digests[0].digest(), None if blake3 is None else digests[1].hexdigest()
 
 class WaBackup:
     """Class to access WhatsApp backups stored in Google Drive."""
 
-    def __init__(self, gmail, password, android_id):
+    def __init__(self, gmail, password, android_id, pool_size=DEFAULT_POOL_SIZE):
         """
         Initialize the WaBackup instance.
 
@@ -116,6 +363,7 @@ class WaBackup:
             gmail (str): The user's Gmail address.
             password (str): The user's Gmail password.
             android_id (str): The user's Android ID.
+            pool_size (int): The number of files to download concurrently.
 
         Raises:
             SystemExit: If login fails.
@@ -131,6 +379,19 @@ class WaBackup:
             "com.whatsapp",
             "38a0f7d505fe18fec64fbf343ecaaaf310dbd799",
         )
+        self.pool_size = pool_size
+        self.session = requests.Session()
+        self.session.mount("https://", HTTPAdapter(
+            pool_connections=HTTP_POOL_CONNECTIONS,
+            pool_maxsize=max(HTTP_POOL_MAXSIZE, pool_size + 1),
+            max_retries=Retry(
+                total=5,
+                backoff_factor=0.3,
+                status_forcelist=RETRY_STATUSES,
+                raise_on_status=False,
+            ),
+        ))
+        self.session.headers["Authorization"] = f"Bearer {self.auth['Auth']}"
 
     def get(self, path, params=None, **kwargs):
         """
@@ -145,9 +406,8 @@ class WaBackup:
             requests.Response: The response object from the GET request.
         """
         try:
-            response = requests.get(
+            response = self.session.get(
                 f"https://backup.googleapis.com/v1/{path}",
-                headers={"Authorization": f"Bearer {self.auth['Auth']}"},
                 params=params,
                 **kwargs,
             )
@@ -173,15 +433,18 @@ class WaBackup:
         Returns:
             dict: The JSON response from the API.
         """
-        return self.get(
+        return json_loads(self.get(
             path,
             None if page_token is None else {"pageToken": page_token},
-        ).json()
+        ).content)
 
     def list_path(self, path):
         """
         List items in the specified path.
 
+        The next page is requested in the background while the items of the
+        current page are being consumed.
+
         Args:
             path (str): The path to list items from.
 
@@ -189,14 +452,15 @@ class WaBackup:
             dict: Each item in the path.
         """
         last_component = path.split("/")[-1]
-        page_token = None
-        while True:
-            page = self.get_page(path, page_token)
-            for item in page[last_component]:
-                yield item
-            if "nextPageToken" not in page:
-                break
-            page_token = page["nextPageToken"]
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            next_page = executor.submit(self.get_page, path)
+            while next_page is not None:
+                page = next_page.result()
+                next_page = None
+                if "nextPageToken" in page:
+                    next_page = executor.submit(self.get_page, path, page["nextPageToken"])
+                for item in page[last_component]:
+                    yield item
 
     def backups(self):
         """
@@ -219,48 +483,96 @@ class WaBackup:
         """
         return self.list_path(f"{backup['name']}/files")
 
-    def fetch(self, file):
+    def fetch(self, file, verified=None, hasher=None):
         """
         Fetch and download a specific file.
 
         Args:
             file (dict): The file item to fetch.
+            verified (VerifiedCache): Optional cache of already verified files.
+            hasher (concurrent.futures.Executor): Optional executor to hash existing files on.
 
         Returns:
             tuple: A tuple containing the file name, size, and MD5 hash.
         """
-        name = os.path.sep.join(file["name"].split("/")[3:])
+        name = local_path(file["name"])
+        size = int(file["sizeBytes"])
         md5Hash = b64decode(file["md5Hash"], validate=True)
-        if not have_file(name, int(file["sizeBytes"]), md5Hash):
-            download_file(
-                name,
-                self.get(file["name"].replace("%", "%25").replace("+", "%2B"), {"alt": "media"}, stream=True)
-            )
-
-        return name, int(file["sizeBytes"]), md5Hash
-
-    def fetch_all(self, backup, cksums):
+        if not have_file(name, size, md5Hash, verified, hasher):
+            for _ in range(DOWNLOAD_ATTEMPTS):
+                downloaded, blake3_hex = download_file(
+                    name,
+                    self.get(quote(file["name"], safe="/"), {"alt": "media"}, stream=True),
+                    size,
+                    md5Hash,
+                )
+                if downloaded:
+                    if verified is not None:
+                        verified.put(name, os.stat(name), md5Hash, blake3_hex)
+                    break
+            else:
+                print("\n\nMD5 mismatch:", name)
+
+        return name, size, md5Hash
+
+    def fetch_all(self, backup, cksums, verified=None, hasher=None):
         """
         Fetch and download all files in a backup.
 
+        Files are handed to the download pool while the backup is still being
+        listed, with at most twice the pool size queued at any time. If a
+        download fails, no more files are queued, the checksums of every other
+        finished download are still written, and the first error is re-raised.
+
         Args:
             backup (dict): The backup item.
             cksums (TextIOWrapper): The file to write checksums to.
+            verified (VerifiedCache): Optional cache of already verified files.
+            hasher (concurrent.futures.Executor): Optional executor to hash existing files on.
         """
         num_files = 0
         total_size = 0
-        files = list(self.backup_files(backup))
+        lines = []
+        last_refresh = 0.0
+        error = None
 
-        with ThreadPool(10) as pool, tqdm(total=len(files), desc="Downloading files") as pbar:
-            downloads = pool.imap_unordered(
-                lambda file: self.fetch(file),
-                files
-            )
-            for name, size, md5Hash in downloads:
-                num_files += 1
-                total_size += size
-                pbar.update(1)
-                cksums.write(f"{md5Hash.hex()} *{name}\n")
+        try:
+            with ThreadPoolExecutor(max_workers=self.pool_size) as executor, tqdm(total=0, desc="Downloading files") as pbar:
+                pending = set()
+                files = self.backup_files(backup)
+                while True:
+                    if error is None:
+                        for file in files:
+                            pending.add(executor.submit(self.fetch, file, verified, hasher))
+                            pbar.total += 1
+                            now = time.monotonic()
+                            if now - last_refresh > PROGRESS_INTERVAL:
+                                pbar.refresh()
+                                last_refresh = now
+                            if len(pending) >= 2 * self.pool_size:
+                                break
+                    if not pending:
+                        break
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for download in done:
+                        try:
+                            name, size, md5Hash = download.result()
+                        except Exception as e:
+                            error = error or e
+                            continue
+                        num_files += 1
+                        total_size += size
+                        pbar.update(1)
+                        lines.append(f"{md5Hash.hex()} *{name}\n")
+                    if len(lines) >= CKSUMS_BATCH_LINES:
+                        cksums.write("".join(lines))
+                        cksums.flush()
+                        lines.clear()
+        finally:
+            cksums.write("".join(lines))
+            cksums.flush()
+        if error is not None:
+            raise error
 
         print(f"\n{num_files} files ({human_size(total_size)})")
 
@@ -272,7 +584,7 @@ def backup_info(backup):
     Args:
         backup (dict): The backup item.
     """
-    metadata = json.loads(backup["metadata"])
+    metadata = json_loads(backup["metadata"])
     for size in ["backupSize", "chatdbSize", "mediaSize", "videoSize"]:
         metadata[size] = human_size(int(metadata[size]))
     
@@ -344,7 +656,7 @@ def list_all():
                 try:
                     num_files += 1
                     total_size += int(file["sizeBytes"])
-                    print(os.path.sep.join(file["name"].split("/")[3:]))
+                    print(local_path(file["name"]))
                 except Exception as e:
                     print(f"\nError processing file: {e}")
             print(f"{num_files} files ({human_size(total_size)})")
@@ -356,13 +668,18 @@ def sync():
 
     This function downloads each backup the user confirms and writes the
     MD5 checksums of the downloaded files to a text file named 'md5sum.txt'.
+    Files verified in earlier runs are remembered in 'verified.sqlite' so they
+    are not hashed again while unchanged; the others are hashed on a process
+    pool so verification uses every CPU core.
     """
     wa_backup, backups = load_backups()
-    with open("md5sum.txt", "w", encoding="utf-8", buffering=1) as cksums:
+    with open("md5sum.txt", "w", encoding="utf-8", buffering=CKSUMS_BUFFER_SIZE) as cksums, \
+            closing(VerifiedCache()) as verified, \
+            ProcessPoolExecutor(mp_context=multiprocessing.get_context("spawn")) as hasher:
         for backup in backups:
             if get_user_confirmation(backup["name"].split("/")[-1]):
                 print(f"Backup Size: {human_size(int(backup['sizeBytes']))} Upload Time: {backup['updateTime']}")
-                wa_backup.fetch_all(backup, cksums)
+                wa_backup.fetch_all(backup, cksums, verified, hasher)
 
 def menu():
     """